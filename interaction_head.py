@@ -7,6 +7,7 @@ The Australian National University
 Australian Centre for Robotic Vision
 """
 
+import math
 import torch
 import torch.nn.functional as F
 import torch.distributed as dist
@@ -14,6 +15,7 @@ import torchvision.ops.boxes as box_ops
 
 from torch.nn import Module
 from torch import nn, Tensor
+from torch.nn.utils.rnn import pad_sequence
 from pocket.ops import Flatten
 from typing import Optional, List, Tuple
 from collections import OrderedDict
@@ -87,17 +89,20 @@ class InteractionHead(Module):
         detections: List[dict],
         targets: List[dict],
         append_gt: Optional[bool] = None
-    ) -> None:
+    ) -> List[dict]:
 
-        results = []
+        if append_gt is None:
+            append_gt = self.training
+
+        # Flatten detections from all images into one batch, so that each
+        # of the following steps is run once regardless of the batch size
+        all_boxes = []; all_labels = []; all_scores = []; all_image_idx = []
         for b_idx, detection in enumerate(detections):
             boxes = detection['boxes']
             labels = detection['labels']
             scores = detection['scores']
 
             # Append ground truth during training
-            if append_gt is None:
-                append_gt = self.training
             if append_gt:
                 target = targets[b_idx]
                 n = target["boxes_h"].shape[0]
@@ -109,77 +114,116 @@ class InteractionHead(Module):
                     labels
                 ])
 
-            # Remove low scoring examples
-            active_idx = torch.nonzero(
-                scores >= self.box_score_thresh
-            ).squeeze(1)
-            # Class-wise non-maximum suppression
-            keep_idx = box_ops.batched_nms(
-                boxes[active_idx],
-                scores[active_idx],
-                labels[active_idx],
+            all_boxes.append(boxes.view(-1, 4))
+            all_labels.append(labels.view(-1))
+            all_scores.append(scores.view(-1))
+            all_image_idx.append(torch.full_like(labels.view(-1), b_idx))
+
+        num_images = len(detections)
+        boxes = torch.cat(all_boxes)
+        labels = torch.cat(all_labels)
+        scores = torch.cat(all_scores)
+        image_idx = torch.cat(all_image_idx)
+
+        # Remove low scoring examples
+        active = scores >= self.box_score_thresh
+        boxes = boxes[active]; labels = labels[active]
+        scores = scores[active]; image_idx = image_idx[active]
+        # Class-wise non-maximum suppression, carried out independently
+        # for each image by combining the class and image indices. Boxes
+        # from different groups are offset so that they do not overlap,
+        # which allows all groups to be suppressed in one pass
+        if boxes.numel() > 0:
+            offsets = (labels * num_images + image_idx).to(boxes) * (boxes.max() + 1)
+            keep = box_ops.nms(
+                boxes + offsets[:, None], scores,
                 self.box_nms_thresh
             )
-            active_idx = active_idx[keep_idx]
-            # Sort detections by scores
-            sorted_idx = torch.argsort(scores[active_idx], descending=True)
-            active_idx = active_idx[sorted_idx]
-            # Keep a fixed number of detections
-            h_idx = torch.nonzero(labels[active_idx] == self.human_idx).squeeze(1)
-            o_idx = torch.nonzero(labels[active_idx] != self.human_idx).squeeze(1)
-            if len(h_idx) > self.max_human:
-                h_idx = h_idx[:self.max_human]
-            if len(o_idx) > self.max_object:
-                o_idx = o_idx[:self.max_object]
-            # Permute humans to the top
-            keep_idx = torch.cat([h_idx, o_idx])
-            active_idx = active_idx[keep_idx]
-
-            results.append(dict(
-                boxes=boxes[active_idx].view(-1, 4),
-                labels=labels[active_idx].view(-1),
-                scores=scores[active_idx].view(-1)
-            
-            ))
+        else:
+            keep = torch.zeros(0, dtype=torch.int64, device=boxes.device)
+        # Group detections by images. The output of NMS is sorted by scores,
+        # which is preserved within each image by using a stable sort
+        keep = keep[torch.sort(image_idx[keep], stable=True)[1]]
+        boxes = boxes[keep]; labels = labels[keep]
+        scores = scores[keep]; image_idx = image_idx[keep]
+
+        # Keep a fixed number of detections
+        is_human = labels == self.human_idx
+        per_image = image_idx[None] == torch.arange(
+            num_images, device=image_idx.device)[:, None]
+        # Rank of each detection amongst humans or objects in the same image
+        h_rank = (per_image & is_human).cumsum(1).gather(0, image_idx[None]).squeeze(0)
+        o_rank = (per_image & ~is_human).cumsum(1).gather(0, image_idx[None]).squeeze(0)
+        keep = torch.where(
+            is_human,
+            h_rank <= self.max_human,
+            o_rank <= self.max_object
+        )
+        boxes = boxes[keep]; labels = labels[keep]
+        scores = scores[keep]; image_idx = image_idx[keep]
+
+        # Permute humans to the top
+        groups = image_idx * 2 + (labels != self.human_idx).long()
+        keep = torch.sort(groups, stable=True)[1]
+        boxes = boxes[keep]; labels = labels[keep]; scores = scores[keep]
+
+        # Number of human and object detections in each image
+        counts = torch.bincount(groups, minlength=2 * num_images).view(-1, 2).tolist()
+        num_boxes = [n_h + n_o for n_h, n_o in counts]
+
+        return [dict(
+            boxes=b, labels=l, scores=s, num_human=c[0]
+        ) for b, l, s, c in zip(
+            boxes.split(num_boxes), labels.split(num_boxes),
+            scores.split(num_boxes), counts
+        )]
+
+    def count_positive_examples(self, results: List[dict]) -> Tensor:
+        """
+        Count positive labels for the two losses, averaged across subprocesses
+        when trained under distributed data parallel. The counts are kept on
+        device to avoid synchronisation with the host
 
-        return results
+        Returns:
+        --------
+        n_p: Tensor
+            (2,) Number of positive labels for interaction classification and
+            interactiveness respectively
+        """
+        labels = torch.cat([result['labels'] for result in results])
+        unary_labels = torch.cat([result['unary_labels'] for result in results])
+        n_p = torch.stack([
+            labels.count_nonzero(),
+            unary_labels.count_nonzero()
+        ]).float()
+        if self.distributed:
+            dist.all_reduce(n_p)
+            return n_p.clamp(min=1) / dist.get_world_size()
+        return n_p.clamp(min=1)
 
-    def compute_interaction_classification_loss(self, results: List[dict]) -> Tensor:
+    def compute_interaction_classification_loss(self,
+        results: List[dict], n_p: Tensor
+    ) -> Tensor:
         scores = []; labels = []
         for result in results:
             scores.append(result['scores'])
             labels.append(result['labels'])
 
-        labels = torch.cat(labels)
-        n_p = len(torch.nonzero(labels))
-        if self.distributed:
-            world_size = dist.get_world_size()
-            n_p = torch.as_tensor([n_p], device='cuda')
-            dist.barrier()
-            dist.all_reduce(n_p)
-            n_p = (n_p / world_size).item()
         loss = binary_focal_loss(
-            torch.cat(scores), labels, reduction='sum', gamma=0.2
+            torch.cat(scores), torch.cat(labels), reduction='sum', gamma=0.2
         )
         return loss / n_p
 
-    def compute_interactiveness_loss(self, results: List[dict]) -> Tensor:
+    def compute_interactiveness_loss(self,
+        results: List[dict], n_p: Tensor
+    ) -> Tensor:
         weights = []; labels = []
         for result in results:
             weights.append(result['weights'])
             labels.append(result['unary_labels'])
 
-        weights = torch.cat(weights)
-        labels = torch.cat(labels)
-        n_p = len(torch.nonzero(labels))
-        if self.distributed:
-            world_size = dist.get_world_size()
-            n_p = torch.as_tensor([n_p], device='cuda')
-            dist.barrier()
-            dist.all_reduce(n_p)
-            n_p = (n_p / world_size).item()
         loss = binary_focal_loss(
-            weights, labels, reduction='sum', gamma=2.0
+            torch.cat(weights), torch.cat(labels), reduction='sum', gamma=2.0
         )
         return loss / n_p
 
@@ -238,23 +282,27 @@ class InteractionHead(Module):
 
         weights = torch.sigmoid(logits_s).squeeze(1)
         scores = torch.sigmoid(logits_p)
+        # Interaction scores do not propagate gradients to the unary weights
+        weights_detached = weights.detach().split(num_boxes)
         weights = weights.split(num_boxes)
         scores = scores.split(num_boxes)
         if len(labels) == 0:
             labels = [None for _ in range(len(num_boxes))]
 
         results = []
-        for w, s, p, b_h, b_o, o, l in zip(
-            weights, scores, prior, boxes_h, boxes_o, object_class, labels
+        for w, w_d, s, p, b_h, b_o, o, l in zip(
+            weights, weights_detached, scores, prior,
+            boxes_h, boxes_o, object_class, labels
         ):
             # Keep valid classes
             x, y = torch.nonzero(p[0]).unbind(1)
+            p = p[:, x, y]
 
             result_dict = dict(
                 boxes_h=b_h, boxes_o=b_o,
                 index=x, prediction=y,
-                scores=s[x, y] * p[:, x, y].prod(dim=0) * w[x].detach(),
-                object=o, prior=p[:, x, y], weights=w
+                scores=s[x, y] * p.prod(dim=0) * w_d[x],
+                object=o, prior=p, weights=w
             )
             # If binary labels are provided
             if l is not None:
@@ -269,7 +317,8 @@ class InteractionHead(Module):
         features: OrderedDict,
         detections: List[dict],
         image_shapes: List[Tuple[int, int]],
-        targets: Optional[List[dict]] = None
+        targets: Optional[List[dict]] = None,
+        preprocessed: bool = False
     ) -> List[dict]:
         """
         Parameters:
@@ -291,6 +340,8 @@ class InteractionHead(Module):
                 Object class indices for each pair
             `labels`: Tensor[G]
                 Target class indices for each pair
+        preprocessed: bool, default: False
+            If True, the detections have already been processed by `preprocess`
 
         Returns:
         --------
@@ -306,21 +357,23 @@ class InteractionHead(Module):
         """
         if self.training:
             assert targets is not None, "Targets should be passed during training"
-        detections = self.preprocess(detections, targets)
+        if not preprocessed:
+            detections = self.preprocess(detections, targets)
 
         box_coords = [detection['boxes'] for detection in detections]
         box_labels = [detection['labels'] for detection in detections]
         box_scores = [detection['scores'] for detection in detections]
+        num_human = [detection['num_human'] for detection in detections]
 
         box_features = self.box_roi_pool(features, box_coords, image_shapes)
 
         box_pair_features, boxes_h, boxes_o, object_class,\
         box_pair_labels, box_pair_prior = self.box_pair_head(
             features, image_shapes, box_features,
-            box_coords, box_labels, box_scores, targets
+            box_coords, box_labels, box_scores, targets,
+            num_human=num_human
         )
 
-        box_pair_features = torch.cat(box_pair_features)
         logits_p = self.box_pair_predictor(box_pair_features)
         logits_s = self.box_pair_suppressor(box_pair_features)
 
@@ -331,9 +384,10 @@ class InteractionHead(Module):
         )
 
         if self.training:
+            n_p = self.count_positive_examples(results)
             loss_dict = dict(
-                hoi_loss=self.compute_interaction_classification_loss(results),
-                interactiveness_loss=self.compute_interactiveness_loss(results)
+                hoi_loss=self.compute_interaction_classification_loss(results, n_p[0]),
+                interactiveness_loss=self.compute_interactiveness_loss(results, n_p[1])
             )
             results.append(loss_dict)
 
@@ -365,24 +419,55 @@ class MultiBranchFusion(Module):
         assert sub_repr_size * cardinality == representation_size, \
             "The given representation size should be divisible by cardinality"
 
-        self.fc_1 = nn.ModuleList([
-            nn.Linear(appearance_size, sub_repr_size)
-            for _ in range(cardinality)
-        ])
-        self.fc_2 = nn.ModuleList([
-            nn.Linear(spatial_size, sub_repr_size)
-            for _ in range(cardinality)
-        ])
-        self.fc_3 = nn.ModuleList([
-            nn.Linear(sub_repr_size, representation_size)
-            for _ in range(cardinality)
-        ])
+        # The homogeneous branches are stacked along the output dimension of
+        # the first two layers and the input dimension of the last layer, so
+        # that all branches are computed by a single linear layer each. The
+        # sum over branches is then carried out by the matrix product in fc_3
+        self.fc_1 = nn.Linear(appearance_size, representation_size)
+        self.fc_2 = nn.Linear(spatial_size, representation_size)
+        self.fc_3 = nn.Linear(representation_size, representation_size)
+        # Initialise the last layer as a sum of independent branches
+        bound = 1 / math.sqrt(sub_repr_size)
+        with torch.no_grad():
+            self.fc_3.weight.uniform_(-bound, bound)
+            self.fc_3.bias.copy_(torch.empty(
+                cardinality, representation_size
+            ).uniform_(-bound, bound).sum(dim=0))
+
+    def _load_from_state_dict(self,
+        state_dict, prefix, local_metadata, strict,
+        missing_keys, unexpected_keys, error_msgs
+    ) -> None:
+        # Convert parameters saved with one linear layer per branch
+        for name in ['fc_1', 'fc_2', 'fc_3']:
+            keys = ['{}{}.{}'.format(prefix, name, i) for i in range(self.cardinality)]
+            if not all(k + '.weight' in state_dict for k in keys):
+                continue
+            weights = [state_dict.pop(k + '.weight') for k in keys]
+            biases = [state_dict.pop(k + '.bias') for k in keys]
+            if name == 'fc_3':
+                state_dict[prefix + name + '.weight'] = torch.cat(weights, 1)
+                state_dict[prefix + name + '.bias'] = torch.stack(biases).sum(0)
+            else:
+                state_dict[prefix + name + '.weight'] = torch.cat(weights, 0)
+                state_dict[prefix + name + '.bias'] = torch.cat(biases, 0)
+        super()._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict,
+            missing_keys, unexpected_keys, error_msgs
+        )
+
+    def encode_spatial(self, spatial: Tensor) -> Tensor:
+        """Project spatial features, which can be reused across multiple passes"""
+        return self.fc_2(spatial)
+
+    def fuse(self, appearance: Tensor, spatial: Tensor) -> Tensor:
+        """Fuse appearance features with projected spatial features"""
+        return F.relu(self.fc_3(F.relu(
+            self.fc_1(appearance) * spatial
+        )))
+
     def forward(self, appearance: Tensor, spatial: Tensor) -> Tensor:
-        return F.relu(torch.stack([
-            fc_3(F.relu(fc_1(appearance) * fc_2(spatial)))
-            for fc_1, fc_2, fc_3
-            in zip(self.fc_1, self.fc_2, self.fc_3)
-        ]).sum(dim=0))
+        return self.fuse(appearance, self.encode_spatial(spatial))
 
 class MessageMBF(MultiBranchFusion):
     """
@@ -418,26 +503,22 @@ class MessageMBF(MultiBranchFusion):
             raise ValueError("Unknown node type \"{}\"".format(node_type))
 
     def _forward_human_nodes(self, appearance: Tensor, spatial: Tensor) -> Tensor:
-        n_h, n = spatial.shape[:2]
-        assert len(appearance) == n_h, "Incorrect size of dim0 for appearance features"
-        return torch.stack([
-            fc_3(F.relu(
-                fc_1(appearance).repeat(n, 1, 1)
-                * fc_2(spatial).permute([1, 0, 2])
-            )) for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
-        ]).sum(dim=0)
+        n_h, n = spatial.shape[-3:-1]
+        assert appearance.shape[-2] == n_h, "Incorrect number of appearance features"
+        # Broadcast appearance features across object nodes and transpose
+        # the output as a view, so that no intermediate is duplicated
+        return self.fc_3(F.relu(
+            self.fc_1(appearance)[..., None, :] * spatial
+        )).transpose(-3, -2)
     def _forward_object_nodes(self, appearance: Tensor, spatial: Tensor) -> Tensor:
-        n_h, n = spatial.shape[:2]
-        assert len(appearance) == n, "Incorrect size of dim0 for appearance features"
-        return torch.stack([
-            fc_3(F.relu(
-                fc_1(appearance).repeat(n_h, 1, 1)
-                * fc_2(spatial)
-            )) for fc_1, fc_2, fc_3 in zip(self.fc_1, self.fc_2, self.fc_3)
-        ]).sum(dim=0)
+        n_h, n = spatial.shape[-3:-1]
+        assert appearance.shape[-2] == n, "Incorrect number of appearance features"
+        return self.fc_3(F.relu(
+            self.fc_1(appearance)[..., None, :, :] * spatial
+        ))
 
-    def forward(self, *args) -> Tensor:
-        return self._forward_method(*args)
+    def fuse(self, appearance: Tensor, spatial: Tensor) -> Tensor:
+        return self._forward_method(appearance, spatial)
 
 class GraphHead(Module):
     """
@@ -483,17 +564,30 @@ class GraphHead(Module):
         self.num_cls = num_cls
         self.human_idx = human_idx
         self.object_class_to_target_class = object_class_to_target_class
+        # Dense lookup table of the mapping from object to target classes
+        obj_to_tar = torch.zeros(len(object_class_to_target_class), num_cls)
+        for obj, tar in enumerate(object_class_to_target_class):
+            obj_to_tar[obj, tar] = 1
+        self.register_buffer('obj_to_tar', obj_to_tar, persistent=False)
+        # Placeholders for images or batches without valid box pairs
+        self.register_buffer('_empty_spatial', torch.zeros(0, 1024), persistent=False)
+        self.register_buffer('_empty_labels', torch.zeros(0, num_cls), persistent=False)
 
         self.fg_iou_thresh = fg_iou_thresh
         self.num_iter = num_iter
 
-        # Box head to map RoI features to low dimensional
+        # Pairwise indices of human and object nodes, cached by graph size
+        self._pair_idx_cache = {}
+
+        # Box head to map RoI features to low dimensional. The first layer is
+        # a convolution with the same size as the pooled features, equivalent
+        # to a fully-connected layer, which avoids flattening the RoI features
         self.box_head = nn.Sequential(
-            Flatten(start_dim=1),
-            nn.Linear(out_channels * roi_pool_size ** 2, node_encoding_size),
+            nn.Conv2d(out_channels, node_encoding_size, roi_pool_size),
+            nn.ReLU(),
+            nn.Conv2d(node_encoding_size, node_encoding_size, 1),
             nn.ReLU(),
-            nn.Linear(node_encoding_size, node_encoding_size),
-            nn.ReLU()
+            Flatten(start_dim=1)
         )
 
         # Compute adjacency matrix
@@ -538,22 +632,80 @@ class GraphHead(Module):
             representation_size, cardinality=16
         )
 
+    def _load_from_state_dict(self,
+        state_dict, prefix, local_metadata, strict,
+        missing_keys, unexpected_keys, error_msgs
+    ) -> None:
+        # Convert parameters of the box head saved with fully-connected layers
+        if prefix + 'box_head.1.weight' in state_dict:
+            fc_1 = [state_dict.pop(prefix + 'box_head.1.' + k) for k in ['weight', 'bias']]
+            fc_2 = [state_dict.pop(prefix + 'box_head.3.' + k) for k in ['weight', 'bias']]
+            state_dict[prefix + 'box_head.0.weight'] = fc_1[0].view(
+                self.node_encoding_size, self.out_channels,
+                self.roi_pool_size, self.roi_pool_size
+            )
+            state_dict[prefix + 'box_head.0.bias'] = fc_1[1]
+            state_dict[prefix + 'box_head.2.weight'] = fc_2[0].view(
+                self.node_encoding_size, self.node_encoding_size, 1, 1
+            )
+            state_dict[prefix + 'box_head.2.bias'] = fc_2[1]
+        super()._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict,
+            missing_keys, unexpected_keys, error_msgs
+        )
+
+    def get_pair_indices(self,
+        n_h: int, n: int,
+        device: torch.device
+    ) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        """
+        Parameters:
+        -----------
+            n_h: int
+                Number of human nodes
+            n: int
+                Number of object nodes (including humans)
+            device: torch.device
+                Device the indices are placed on
+
+        Returns:
+        --------
+            x: Tensor[n_h * n]
+                Indices of human nodes for every human-object pair
+            y: Tensor[n_h * n]
+                Indices of object nodes for every human-object pair
+            x_keep: Tensor[M]
+                Indices of human nodes, excluding pairs with the same instance
+            y_keep: Tensor[M]
+                Indices of object nodes, excluding pairs with the same instance
+        """
+        key = (n_h, n, device)
+        if key not in self._pair_idx_cache:
+            # Indices are computed on CPU once for each graph size
+            x = torch.arange(n_h).repeat_interleave(n)
+            y = torch.arange(n).repeat(n_h)
+            # Remove pairs consisting of the same human instance
+            keep = x != y
+            self._pair_idx_cache[key] = tuple(
+                idx.to(device) for idx in [x, y, x[keep], y[keep]]
+            )
+        return self._pair_idx_cache[key]
+
     def associate_with_ground_truth(self,
         boxes_h: Tensor,
         boxes_o: Tensor,
         targets: List[dict]
     ) -> Tensor:
-        n = boxes_h.shape[0]
-        labels = torch.zeros(n, self.num_cls, device=boxes_h.device)
-
-        x, y = torch.nonzero(torch.min(
+        match = torch.min(
             box_ops.box_iou(boxes_h, targets["boxes_h"]),
             box_ops.box_iou(boxes_o, targets["boxes_o"])
-        ) >= self.fg_iou_thresh).unbind(1)
-
-        labels[x, targets["labels"][y]] = 1
+        ) >= self.fg_iou_thresh
+        # One-hot encodings of the target classes for each ground truth pair
+        target_labels = torch.zeros(
+            len(targets["labels"]), self.num_cls, device=boxes_h.device
+        ).scatter_(1, targets["labels"][:, None], 1)
 
-        return labels
+        return torch.mm(match.float(), target_labels).clamp(max=1)
 
     def compute_prior_scores(self,
         x: Tensor, y: Tensor,
@@ -572,35 +724,30 @@ class GraphHead(Module):
             object_class: Tensor[N]
                 Object class indices (before pairing)
         """
-        prior_h = torch.zeros(len(x), self.num_cls, device=scores.device)
-        prior_o = torch.zeros_like(prior_h)
-
+        s_h = scores[x]
+        s_o = scores[y]
         # Raise the power of object detection scores during inference
-        p = 1.0 if self.training else 2.8
-        s_h = scores[x].pow(p)
-        s_o = scores[y].pow(p)
+        if not self.training:
+            s_h = s_h.pow(2.8)
+            s_o = s_o.pow(2.8)
 
         # Map object class index to target class index
         # Object class index to target class index is a one-to-many mapping
-        target_cls_idx = [self.object_class_to_target_class[obj.item()]
-            for obj in object_class[y]]
-        # Duplicate box pair indices for each target class
-        pair_idx = [i for i, tar in enumerate(target_cls_idx) for _ in tar]
-        # Flatten mapped target indices
-        flat_target_idx = [t for tar in target_cls_idx for t in tar]
-
-        prior_h[pair_idx, flat_target_idx] = s_h[pair_idx]
-        prior_o[pair_idx, flat_target_idx] = s_o[pair_idx]
+        target_mask = self.obj_to_tar[object_class[y]]
 
-        return torch.stack([prior_h, prior_o])
+        return torch.stack([
+            target_mask * s_h[:, None],
+            target_mask * s_o[:, None]
+        ])
 
     def forward(self,
         features: OrderedDict, image_shapes: List[Tuple[int, int]],
         box_features: Tensor, box_coords: List[Tensor],
         box_labels: List[Tensor], box_scores: List[Tensor],
-        targets: Optional[List[dict]] = None
+        targets: Optional[List[dict]] = None,
+        num_human: Optional[List[int]] = None
     ) -> Tuple[
-        List[Tensor], List[Tensor], List[Tensor],
+        Tensor, List[Tensor], List[Tensor],
         List[Tensor], List[Tensor], List[Tensor]
     ]:
         """
@@ -615,7 +762,8 @@ class GraphHead(Module):
             box_coords: List[Tensor]
                 Bounding box coordinates organised by images
             box_labels: List[Tensor]
-                Bounding box object types organised by images
+                Bounding box object types organised by images. Human detections
+                should be permuted to the top in each image
             box_scores: List[Tensor]
                 Bounding box scores organised by images
             targets: List[dict]
@@ -623,10 +771,14 @@ class GraphHead(Module):
                 `boxes_h`: Tensor[G, 4]
                 `boxes_o`: Tensor[G, 4]
                 `labels`: Tensor[G]
+            num_human: List[int], optional
+                Number of human detections in each image. If not given, it will
+                be counted from the box labels
 
         Returns:
         --------
-            all_box_pair_features: List[Tensor]
+            box_pair_features: Tensor
+                (M, 2 * R) Box pair features of all images, concatenated in order
             all_boxes_h: List[Tensor]
             all_boxes_o: List[Tensor]
             all_object_class: List[Tensor]
@@ -638,120 +790,179 @@ class GraphHead(Module):
 
         global_features = self.avg_pool(features['3']).flatten(start_dim=1)
         box_features = self.box_head(box_features)
+        device = box_features.device
 
         num_boxes = [len(boxes_per_image) for boxes_per_image in box_coords]
-        
+        if num_human is None:
+            num_human = torch.stack([
+                torch.sum(labels == self.human_idx) for labels in box_labels
+            ]).tolist()
+
+        # Skip images when there are no detected human or object instances
+        # and when there is only one detected instance
+        valid = [
+            b_idx for b_idx, (n_h, n) in enumerate(zip(num_human, num_boxes))
+            if n_h > 0 and n > 1
+        ]
+        # Graphs of all images are padded to the same size and updated together
+        max_n_h = max([num_human[b_idx] for b_idx in valid], default=0)
+        max_n = max([num_boxes[b_idx] for b_idx in valid], default=0)
+
         counter = 0
-        all_boxes_h = []; all_boxes_o = []; all_object_class = []
-        all_labels = []; all_prior = []
-        all_box_pair_features = []
-        for b_idx, (coords, labels, scores) in enumerate(zip(box_coords, box_labels, box_scores)):
-            n = num_boxes[b_idx]
-            device = box_features.device
-
-            n_h = torch.sum(labels == self.human_idx).item()
-            # Skip image when there are no detected human or object instances
-            # and when there is only one detected instance
+        node_encodings = []; h_node_encodings = []
+        pair_boxes_h = []; pair_boxes_o = []; pair_shapes = []
+        # Indices of all human-object pairs in the padded graphs
+        pair_idx = []
+        # Indices of human-object pairs excluding those with the same instance,
+        # in the padded graphs and amongst boxes of all images respectively
+        keep_h_idx = []; keep_o_idx = []; keep_pair_idx = []
+        box_h_idx = []; box_o_idx = []; image_idx = []
+        pair_counts = []
+        for b_idx, (coords, n_h, n) in enumerate(zip(box_coords, num_human, num_boxes)):
             if n_h == 0 or n <= 1:
-                all_box_pair_features.append(torch.zeros(
-                    0, 2 * self.representation_size,
-                    device=device)
-                )
-                all_boxes_h.append(torch.zeros(0, 4, device=device))
-                all_boxes_o.append(torch.zeros(0, 4, device=device))
-                all_object_class.append(torch.zeros(0, device=device, dtype=torch.int64))
-                all_prior.append(torch.zeros(2, 0, self.num_cls, device=device))
-                all_labels.append(torch.zeros(0, self.num_cls, device=device))
+                pair_counts.append(0)
+                counter += n
                 continue
-            if not torch.all(labels[:n_h]==self.human_idx):
-                raise ValueError("Human detections are not permuted to the top")
+            g_idx = len(node_encodings)
 
-            node_encodings = box_features[counter: counter+n]
+            node_encodings.append(box_features[counter: counter+n])
             # Duplicate human nodes
-            h_node_encodings = node_encodings[:n_h]
+            h_node_encodings.append(box_features[counter: counter+n_h])
             # Get the pairwise index between every human and object instance
-            x, y = torch.meshgrid(
-                torch.arange(n_h, device=device),
-                torch.arange(n, device=device)
-            )
-            # Remove pairs consisting of the same human instance
-            x_keep, y_keep = torch.nonzero(x != y).unbind(1)
-            if len(x_keep) == 0:
-                # Should never happen, just to be safe
-                raise ValueError("There are no valid human-object pairs")
+            x, y, x_keep, y_keep = self.get_pair_indices(n_h, n, device)
             # Human nodes have been duplicated and will be treated independently
             # of the humans included amongst object nodes
-            x = x.flatten(); y = y.flatten()
 
-            # Compute spatial features
-            box_pair_spatial = compute_spatial_encodings(
-                [coords[x]], [coords[y]], [image_shapes[b_idx]]
+            # Collect box pairs, of which spatial features are computed
+            # for all images at once
+            pair_boxes_h.append(coords[x])
+            pair_boxes_o.append(coords[y])
+            pair_shapes.append(image_shapes[b_idx])
+
+            pair_idx.append((g_idx * max_n_h + x) * max_n + y)
+            keep_h_idx.append(g_idx * max_n_h + x_keep)
+            keep_o_idx.append(g_idx * max_n + y_keep)
+            keep_pair_idx.append((g_idx * max_n_h + x_keep) * max_n + y_keep)
+            box_h_idx.append(counter + x_keep)
+            box_o_idx.append(counter + y_keep)
+            image_idx.append(torch.full_like(x_keep, b_idx))
+            pair_counts.append(len(x_keep))
+
+            counter += n
+
+        box_coords = torch.cat(box_coords)
+        box_labels = torch.cat(box_labels)
+        box_scores = torch.cat(box_scores)
+        box_h_idx = torch.cat(box_h_idx) if len(valid) else box_labels.new_zeros(0)
+        box_o_idx = torch.cat(box_o_idx) if len(valid) else box_labels.new_zeros(0)
+
+        if len(valid):
+            num_graphs = len(valid)
+            node_encodings = pad_sequence(node_encodings, batch_first=True)
+            h_node_encodings = pad_sequence(h_node_encodings, batch_first=True)
+            # Compute spatial features and scatter them into padded graphs
+            pair_idx = torch.cat(pair_idx)
+            box_pair_spatial = self.spatial_head(compute_spatial_encodings(
+                pair_boxes_h, pair_boxes_o, pair_shapes
+            ))
+            box_pair_spatial = box_pair_spatial.new_zeros(
+                num_graphs * max_n_h * max_n, box_pair_spatial.shape[1]
+            ).index_copy(0, pair_idx, box_pair_spatial).view(
+                num_graphs, max_n_h, max_n, -1
             )
-            box_pair_spatial = self.spatial_head(box_pair_spatial)
-            # Reshape the spatial features
-            box_pair_spatial_reshaped = box_pair_spatial.reshape(n_h, n, -1)
+            # Edges outside of the actual graphs are masked out
+            pair_mask = torch.zeros(
+                num_graphs * max_n_h * max_n,
+                dtype=torch.bool, device=device
+            ).index_fill_(0, pair_idx, True).view(num_graphs, max_n_h, max_n)
+
+            # Spatial features are constant across iterations, and are
+            # therefore projected only once
+            spatial_attention = self.attention_head.encode_spatial(box_pair_spatial)
+            spatial_obj_to_sub = self.obj_to_sub.encode_spatial(box_pair_spatial)
+            spatial_sub_to_obj = self.sub_to_obj.encode_spatial(box_pair_spatial)
 
-            adjacency_matrix = torch.ones(n_h, n, device=device)
             for _ in range(self.num_iter):
                 # Compute weights of each edge
-                weights = self.attention_head(
+                weights = self.attention_head.fuse(
                     torch.cat([
-                        h_node_encodings[x],
-                        node_encodings[y]
-                    ], 1),
-                    box_pair_spatial
+                        h_node_encodings[:, :, None].expand(-1, -1, max_n, -1),
+                        node_encodings[:, None].expand(-1, max_n_h, -1, -1)
+                    ], -1),
+                    spatial_attention
+                )
+                adjacency_matrix = self.adjacency(weights).squeeze(-1).masked_fill(
+                    ~pair_mask, torch.finfo(weights.dtype).min
                 )
-                adjacency_matrix = self.adjacency(weights).reshape(n_h, n)
 
-                # Update human nodes
-                messages_to_h = F.relu(torch.sum(
-                    adjacency_matrix.softmax(dim=1)[..., None] *
-                    self.obj_to_sub(
+                # Update human nodes. Messages are aggregated with a matrix
+                # product, without materialising the weighted messages
+                messages_to_h = F.relu(torch.matmul(
+                    adjacency_matrix.softmax(dim=-1)[..., None, :],
+                    self.obj_to_sub.fuse(
                         node_encodings,
-                        box_pair_spatial_reshaped
-                    ), dim=1)
+                        spatial_obj_to_sub
+                    )).squeeze(-2)
                 )
                 h_node_encodings = self.norm_h(
                     h_node_encodings + messages_to_h
                 )
 
                 # Update object nodes (including human nodes)
-                messages_to_o = F.relu(torch.sum(
-                    adjacency_matrix.t().softmax(dim=1)[..., None] *
-                    self.sub_to_obj(
+                messages_to_o = F.relu(torch.matmul(
+                    adjacency_matrix.transpose(-2, -1).softmax(dim=-1)[..., None, :],
+                    self.sub_to_obj.fuse(
                         h_node_encodings,
-                        box_pair_spatial_reshaped
-                    ), dim=1)
+                        spatial_sub_to_obj
+                    )).squeeze(-2)
                 )
                 node_encodings = self.norm_o(
                     node_encodings + messages_to_o
                 )
 
-            if targets is not None:
-                all_labels.append(self.associate_with_ground_truth(
-                    coords[x_keep], coords[y_keep], targets[b_idx])
-                )
-                
-            all_box_pair_features.append(torch.cat([
-                self.attention_head(
-                    torch.cat([
-                        h_node_encodings[x_keep],
-                        node_encodings[y_keep]
-                        ], 1),
-                    box_pair_spatial_reshaped[x_keep, y_keep]
-                ), self.attention_head_g(
-                    global_features[b_idx, None],
-                    box_pair_spatial_reshaped[x_keep, y_keep])
-            ], dim=1))
-            all_boxes_h.append(coords[x_keep])
-            all_boxes_o.append(coords[y_keep])
-            all_object_class.append(labels[y_keep])
-            # The prior score is the product of the object detection scores
-            all_prior.append(self.compute_prior_scores(
-                x_keep, y_keep, scores, labels)
+            # Gather node encodings and spatial features for the box pairs
+            h_node_encodings = h_node_encodings.flatten(0, 1)[torch.cat(keep_h_idx)]
+            node_encodings = node_encodings.flatten(0, 1)[torch.cat(keep_o_idx)]
+            keep_pair_idx = torch.cat(keep_pair_idx)
+            box_pair_spatial = box_pair_spatial.flatten(0, 2)[keep_pair_idx]
+            spatial_attention = spatial_attention.flatten(0, 2)[keep_pair_idx]
+            global_features = global_features[torch.cat(image_idx)]
+        else:
+            h_node_encodings = node_encodings = box_features[:0]
+            box_pair_spatial = self._empty_spatial
+            spatial_attention = self.attention_head.encode_spatial(box_pair_spatial)
+            global_features = global_features[:0]
+
+        box_pair_features = torch.cat([
+            self.attention_head.fuse(
+                torch.cat([
+                    h_node_encodings,
+                    node_encodings
+                ], 1),
+                spatial_attention
+            ), self.attention_head_g(
+                global_features,
+                box_pair_spatial
             )
-
-            counter += n
-
-        return all_box_pair_features, all_boxes_h, all_boxes_o, \
+        ], dim=1)
+
+        boxes_h = box_coords[box_h_idx]
+        boxes_o = box_coords[box_o_idx]
+        all_boxes_h = list(boxes_h.split(pair_counts))
+        all_boxes_o = list(boxes_o.split(pair_counts))
+        all_object_class = list(box_labels[box_o_idx].split(pair_counts))
+        # The prior score is the product of the object detection scores
+        all_prior = list(self.compute_prior_scores(
+            box_h_idx, box_o_idx, box_scores, box_labels
+        ).split(pair_counts, dim=1))
+
+        all_labels = []
+        if targets is not None:
+            for b_h, b_o, target in zip(all_boxes_h, all_boxes_o, targets):
+                if len(b_h) == 0:
+                    all_labels.append(self._empty_labels)
+                    continue
+                all_labels.append(self.associate_with_ground_truth(b_h, b_o, target))
+
+        return box_pair_features, all_boxes_h, all_boxes_o, \
             all_object_class, all_labels, all_prior
@@ -34,19 +34,22 @@ def main(rank, args):
         name=args.dataset, partition=args.partitions[0],
         data_root=args.data_root,
         detection_root=args.train_detection_dir,
-        flip=True
+        flip=True,
+        detection_cache_root=args.train_detection_cache_dir
     )
 
     valset = DataFactory(
         name=args.dataset, partition=args.partitions[1],
         data_root=args.data_root,
-        detection_root=args.val_detection_dir
+        detection_root=args.val_detection_dir,
+        detection_cache_root=args.val_detection_cache_dir
     )
 
     train_loader = DataLoader(
         dataset=trainset,
         collate_fn=custom_collate, batch_size=args.batch_size,
         num_workers=args.num_workers, pin_memory=True,
+        persistent_workers=args.num_workers > 0,
         sampler=DistributedSampler(
             trainset, 
             num_replicas=args.world_size, 
@@ -57,6 +60,7 @@ def main(rank, args):
         dataset=valset,
         collate_fn=custom_collate, batch_size=args.batch_size,
         num_workers=args.num_workers, pin_memory=True,
+        persistent_workers=args.num_workers > 0,
         sampler=DistributedSampler(
             valset, 
             num_replicas=args.world_size, 
@@ -144,6 +148,10 @@ if __name__ == '__main__':
     parser.add_argument('--data-root', default='hicodet', type=str)
     parser.add_argument('--train-detection-dir', default='hicodet/detections/train2015', type=str)
     parser.add_argument('--val-detection-dir', default='hicodet/detections/test2015', type=str)
+    parser.add_argument('--train-detection-cache-dir', default=None, type=str,
+                        help="Directory to cache parsed training detections in")
+    parser.add_argument('--val-detection-cache-dir', default=None, type=str,
+                        help="Directory to cache parsed validation detections in")
     parser.add_argument('--num-iter', default=2, type=int,
                         help="Number of iterations to run message passing")
     parser.add_argument('--num-epochs', default=8, type=int)
@@ -42,6 +42,8 @@ class GenericHOINetwork(nn.Module):
         self.transform = transform
 
         self.postprocess = postprocess
+        # Side stream for the preprocessing of detections
+        self._preprocess_stream = None
 
     def preprocess(self,
         images: List[Tensor],
@@ -85,9 +87,30 @@ class GenericHOINetwork(nn.Module):
         images, detections, targets, original_image_sizes = self.preprocess(
                 images, detections, targets)
 
-        features = self.backbone(images.tensors)
-        results = self.interaction_head(features, detections, 
-            images.image_sizes, targets)
+        if images.tensors.is_cuda:
+            # Preprocess detections on a side stream that does not wait for the
+            # backbone, so that its synchronisations with the host overlap with
+            # the computation of feature maps
+            if self._preprocess_stream is None:
+                self._preprocess_stream = torch.cuda.Stream(images.tensors.device)
+            stream = self._preprocess_stream
+            stream.wait_stream(torch.cuda.current_stream())
+            features = self.backbone(images.tensors)
+            with torch.cuda.stream(stream):
+                detections = self.interaction_head.preprocess(detections, targets)
+            torch.cuda.current_stream().wait_stream(stream)
+            # Prevent memory allocated on the side stream from being reused
+            # before the main stream is done with it
+            for det in detections:
+                for v in det.values():
+                    if isinstance(v, Tensor):
+                        v.record_stream(torch.cuda.current_stream())
+            results = self.interaction_head(features, detections,
+                images.image_sizes, targets, preprocessed=True)
+        else:
+            features = self.backbone(images.tensors)
+            results = self.interaction_head(features, detections,
+                images.image_sizes, targets)
 
         if self.postprocess and results is not None:
             return self.transform.postprocess(
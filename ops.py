@@ -8,7 +8,6 @@ Australian Centre for Robotic Vision
 """
 
 import torch
-import torchvision.ops.boxes as box_ops
 
 from torch import Tensor
 from typing import List, Tuple
@@ -34,45 +33,109 @@ def compute_spatial_encodings(
         Tensor
             Computed spatial encodings between the boxes (N, 36)
     """
-    features = []
-    for b1, b2, shape in zip(boxes_1, boxes_2, shapes):
-        h, w = shape
-
-        c1_x = (b1[:, 0] + b1[:, 2]) / 2; c1_y = (b1[:, 1] + b1[:, 3]) / 2
-        c2_x = (b2[:, 0] + b2[:, 2]) / 2; c2_y = (b2[:, 1] + b2[:, 3]) / 2
-
-        b1_w = b1[:, 2] - b1[:, 0]; b1_h = b1[:, 3] - b1[:, 1]
-        b2_w = b2[:, 2] - b2[:, 0]; b2_h = b2[:, 3] - b2[:, 1]
-
-        d_x = torch.abs(c2_x - c1_x) / (b1_w + eps)
-        d_y = torch.abs(c2_y - c1_y) / (b1_h + eps)
-
-        iou = torch.diag(box_ops.box_iou(b1, b2))
-
-        # Construct spatial encoding
-        f = torch.stack([
-            # Relative position of box centre
-            c1_x / w, c1_y / h, c2_x / w, c2_y / h,
-            # Relative box width and height
-            b1_w / w, b1_h / h, b2_w / w, b2_h / h,
-            # Relative box area
-            b1_w * b1_h / (h * w), b2_w * b2_h / (h * w),
-            b2_w * b2_h / (b1_w * b1_h + eps),
-            # Box aspect ratio
-            b1_w / (b1_h + eps), b2_w / (b2_h + eps),
-            # Intersection over union
-            iou,
-            # Relative distance and direction of the object w.r.t. the person
-            (c2_x > c1_x).float() * d_x,
-            (c2_x < c1_x).float() * d_x,
-            (c2_y > c1_y).float() * d_y,
-            (c2_y < c1_y).float() * d_y,
-        ], 1)
-
-        features.append(
-            torch.cat([f, torch.log(f + eps)], 1)
+    # Image heights and widths for each box pair
+    h = torch.cat([b.new_full((len(b),), shape[0]) for b, shape in zip(boxes_1, shapes)])
+    w = torch.cat([b.new_full((len(b),), shape[1]) for b, shape in zip(boxes_1, shapes)])
+    b1 = torch.cat(boxes_1); b2 = torch.cat(boxes_2)
+
+    c1_x = (b1[:, 0] + b1[:, 2]) / 2; c1_y = (b1[:, 1] + b1[:, 3]) / 2
+    c2_x = (b2[:, 0] + b2[:, 2]) / 2; c2_y = (b2[:, 1] + b2[:, 3]) / 2
+
+    b1_w = b1[:, 2] - b1[:, 0]; b1_h = b1[:, 3] - b1[:, 1]
+    b2_w = b2[:, 2] - b2[:, 0]; b2_h = b2[:, 3] - b2[:, 1]
+
+    d_x = torch.abs(c2_x - c1_x) / (b1_w + eps)
+    d_y = torch.abs(c2_y - c1_y) / (b1_h + eps)
+
+    # Element-wise intersection over union between the paired boxes
+    inter = (
+        torch.min(b1[:, 2], b2[:, 2]) - torch.max(b1[:, 0], b2[:, 0])
+    ).clamp(min=0) * (
+        torch.min(b1[:, 3], b2[:, 3]) - torch.max(b1[:, 1], b2[:, 1])
+    ).clamp(min=0)
+    iou = inter / (b1_w * b1_h + b2_w * b2_h - inter)
+
+    # Construct spatial encoding
+    f = torch.stack([
+        # Relative position of box centre
+        c1_x / w, c1_y / h, c2_x / w, c2_y / h,
+        # Relative box width and height
+        b1_w / w, b1_h / h, b2_w / w, b2_h / h,
+        # Relative box area
+        b1_w * b1_h / (h * w), b2_w * b2_h / (h * w),
+        b2_w * b2_h / (b1_w * b1_h + eps),
+        # Box aspect ratio
+        b1_w / (b1_h + eps), b2_w / (b2_h + eps),
+        # Intersection over union
+        iou,
+        # Relative distance and direction of the object w.r.t. the person
+        (c2_x > c1_x).float() * d_x,
+        (c2_x < c1_x).float() * d_x,
+        (c2_y > c1_y).float() * d_y,
+        (c2_y < c1_y).float() * d_y,
+    ], 1)
+
+    return torch.cat([f, torch.log(f + eps)], 1)
+
+@torch.jit.script
+def _box_iou(boxes_1: Tensor, boxes_2: Tensor) -> Tensor:
+    """
+    Pairwise intersection over union between (..., M, 4) and (..., N, 4) boxes,
+    batched over the leading dimensions and scripted so that the operations
+    can be fused
+    """
+    area_1 = (boxes_1[..., 2] - boxes_1[..., 0]) * (boxes_1[..., 3] - boxes_1[..., 1])
+    area_2 = (boxes_2[..., 2] - boxes_2[..., 0]) * (boxes_2[..., 3] - boxes_2[..., 1])
+
+    tl = torch.max(boxes_1[..., :, None, :2], boxes_2[..., None, :, :2])
+    br = torch.min(boxes_1[..., :, None, 2:], boxes_2[..., None, :, 2:])
+    inter = (br - tl).clamp(min=0).prod(-1)
+
+    return inter / (area_1[..., :, None] + area_2[..., None, :] - inter)
+
+@torch.jit.script
+def box_pair_iou(
+    boxes_h_1: Tensor, boxes_o_1: Tensor,
+    boxes_h_2: Tensor, boxes_o_2: Tensor
+) -> Tensor:
+    """
+    Pairwise intersection over union between two sets of box pairs, taken as
+    the minimum of the IoU between human boxes and that between object boxes
+
+    Parameters:
+    -----------
+        boxes_h_1: Tensor[M, 4]
+            Human boxes of the first set of box pairs
+        boxes_o_1: Tensor[M, 4]
+            Object boxes of the first set of box pairs
+        boxes_h_2: Tensor[N, 4]
+            Human boxes of the second set of box pairs
+        boxes_o_2: Tensor[N, 4]
+            Object boxes of the second set of box pairs
+
+    Returns:
+    --------
+        Tensor[M, N]
+            Computed intersection over union between the box pairs
+    """
+    # Human and object boxes are stacked, so that both IoU matrices are
+    # computed with the same broadcast operations
+    iou = _box_iou(
+        torch.stack([boxes_h_1, boxes_o_1]),
+        torch.stack([boxes_h_2, boxes_o_2])
+    )
+    return torch.min(iou[0], iou[1])
+
+@torch.jit.script
+def _binary_focal_loss(
+    x: Tensor, y: Tensor,
+    alpha: float, gamma: float, eps: float
+) -> Tensor:
+    """Element-wise focal loss, scripted so that the operations can be fused"""
+    return (1 - y - alpha).abs() * ((y - x).abs() + eps) ** gamma * \
+        torch.nn.functional.binary_cross_entropy(
+            x, y, reduction='none'
         )
-    return torch.cat(features)
 
 def binary_focal_loss(
     x: Tensor, y: Tensor,
@@ -107,10 +170,8 @@ def binary_focal_loss(
         loss: Tensor
             Computed loss tensor
     """
-    loss = (1 - y - alpha).abs() * ((y-x).abs() + eps) ** gamma * \
-        torch.nn.functional.binary_cross_entropy(
-            x, y, reduction='none'
-        )
+    # The scripted function is strictly typed, so integer arguments are converted
+    loss = _binary_focal_loss(x, y, float(alpha), float(gamma), float(eps))
     if reduction == 'mean':
         return loss.mean()
     elif reduction == 'sum':
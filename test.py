@@ -33,6 +33,7 @@ def main(args):
             name='hicodet', partition=args.partition,
             data_root=args.data_root,
             detection_root=args.detection_dir,
+            detection_cache_root=args.detection_cache_dir
         ), collate_fn=custom_collate, batch_size=1,
         num_workers=args.num_workers, pin_memory=True
     )
@@ -70,6 +71,8 @@ if __name__ == "__main__":
     parser.add_argument('--data-root', default='hicodet', type=str)
     parser.add_argument('--detection-dir', default='hicodet/detections/test2015',
                         type=str, help="Directory where detection files are stored")
+    parser.add_argument('--detection-cache-dir', default=None, type=str,
+                        help="Directory to cache parsed detections in")
     parser.add_argument('--partition', default='test2015', type=str)
     parser.add_argument('--num-iter', default=2, type=int,
                         help="Number of iterations to run message passing")
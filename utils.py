@@ -11,20 +11,19 @@ import os
 import json
 import time
 import torch
-import numpy as np
 from tqdm import tqdm
 import torch.distributed as dist
 
 from torch.utils.data import Dataset
-from torchvision.ops.boxes import box_iou
-from torchvision.transforms.functional import hflip
 
 from vcoco.vcoco import VCOCO
 from hicodet.hicodet import HICODet
 
+from ops import box_pair_iou
+
 import pocket
 from pocket.core import DistributedLearningEngine
-from pocket.utils import DetectionAPMeter, HandyTimer, BoxPairAssociation, all_gather
+from pocket.utils import DetectionAPMeter, HandyTimer
 
 def custom_collate(batch):
     images = []
@@ -36,13 +35,63 @@ def custom_collate(batch):
         targets.append(tar)
     return images, detections, targets
 
+class CUDAPrefetcher:
+    """
+    Iterate over a data loader, copying the next batch to GPU on a side
+    stream while the current batch is being processed
+
+    Parameters:
+    -----------
+        loader: iterable
+            Data loader, preferably with pinned memory
+    """
+    def __init__(self, loader):
+        self.loader = iter(loader)
+        self.stream = torch.cuda.Stream()
+        self._preload()
+
+    def _preload(self):
+        try:
+            self.next = next(self.loader)
+        except StopIteration:
+            self.next = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next = pocket.ops.relocate_to_cuda(self.next, non_blocking=True)
+
+    def _record_stream(self, x, stream):
+        # Prevent memory of the tensors from being reused before the
+        # consuming stream is done with them
+        if isinstance(x, torch.Tensor):
+            x.record_stream(stream)
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                self._record_stream(v, stream)
+        elif isinstance(x, dict):
+            for v in x.values():
+                self._record_stream(v, stream)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        stream = torch.cuda.current_stream()
+        stream.wait_stream(self.stream)
+        batch = self.next
+        if batch is None:
+            raise StopIteration
+        self._record_stream(batch, stream)
+        self._preload()
+        return batch
+
 class DataFactory(Dataset):
     def __init__(self,
             name, partition,
             data_root, detection_root,
             flip=False,
             box_score_thresh_h=0.2,
-            box_score_thresh_o=0.2
+            box_score_thresh_o=0.2,
+            detection_cache_root=None
             ):
         if name not in ['hicodet', 'vcoco']:
             raise ValueError("Unknown dataset ", name)
@@ -56,6 +105,12 @@ class DataFactory(Dataset):
                 target_transform=pocket.ops.ToTensor(input_format='dict')
             )
             self.human_idx = 49
+            # Lookup table from object and verb indices to interaction indices,
+            # where invalid combinations are marked as -1
+            self.interaction_lut = torch.as_tensor([
+                [-1 if hoi_idx is None else hoi_idx for hoi_idx in verbs]
+                for verbs in self.dataset.object_n_verb_to_interaction
+            ], dtype=torch.int32)
         else:
             assert partition in ['train', 'val', 'trainval', 'test'], \
                 "Unknown V-COCO partition " + partition
@@ -74,11 +129,27 @@ class DataFactory(Dataset):
 
         self.name = name
         self.detection_root = detection_root
+        # Paths to detection files and their caches, computed once for all images.
+        # Detections parsed from json files are only cached as serialised tensors
+        # when a separate cache directory is given
+        filenames = [
+            os.path.splitext(self.dataset.filename(i))[0]
+            for i in range(len(self.dataset))
+        ]
+        self._det_paths = [
+            os.path.join(detection_root, f + '.json') for f in filenames
+        ]
+        self._det_cache_paths = None if detection_cache_root is None else [
+            os.path.join(detection_cache_root, f + '.pt') for f in filenames
+        ]
 
         self.box_score_thresh_h = box_score_thresh_h
         self.box_score_thresh_o = box_score_thresh_o
         self._flip = torch.randint(0, 2, (len(self.dataset),)) if flip \
             else torch.zeros(len(self.dataset))
+        # Place flipping flags in shared memory, so that they are not
+        # duplicated in each of the data loader workers
+        self._flip.share_memory_()
 
     def __len__(self):
         return len(self.dataset)
@@ -86,26 +157,60 @@ class DataFactory(Dataset):
     def filter_detections(self, detection):
         """Perform NMS and remove low scoring examples"""
 
-        boxes = torch.as_tensor(detection['boxes'])
-        labels = torch.as_tensor(detection['labels'])
-        scores = torch.as_tensor(detection['scores'])
+        boxes = detection['boxes']
+        labels = detection['labels']
+        scores = detection['scores']
+        # Detections are loaded as tensors. Convert other formats only
+        if not torch.is_tensor(boxes):
+            boxes = torch.as_tensor(boxes)
+            labels = torch.as_tensor(labels)
+            scores = torch.as_tensor(scores)
+
+        # Filter out low scoring human and object boxes, with respective thresholds
+        keep = torch.where(
+            labels == self.human_idx,
+            scores >= self.box_score_thresh_h,
+            scores >= self.box_score_thresh_o
+        )
 
-        # Filter out low scoring human boxes
-        idx = torch.nonzero(labels == self.human_idx).squeeze(1)
-        keep_idx = idx[torch.nonzero(scores[idx] >= self.box_score_thresh_h).squeeze(1)]
+        # Boxes are reshaped in case there are no detections, in which case
+        # boxes loaded from an empty list do not have the second dimension
+        boxes = boxes[keep].view(-1, 4)
+        scores = scores[keep]
+        labels = labels[keep]
 
-        # Filter out low scoring object boxes
-        idx = torch.nonzero(labels != self.human_idx).squeeze(1)
-        keep_idx = torch.cat([
-            keep_idx,
-            idx[torch.nonzero(scores[idx] >= self.box_score_thresh_o).squeeze(1)]
-        ])
+        return dict(boxes=boxes, labels=labels, scores=scores)
 
-        boxes = boxes[keep_idx].view(-1, 4)
-        scores = scores[keep_idx].view(-1)
-        labels = labels[keep_idx].view(-1)
+    def load_detection(self, i):
+        """Load detections of an image, using the tensor cache when available"""
+        detection_path = self._det_paths[i]
+        if self._det_cache_paths is not None:
+            cache_path = self._det_cache_paths[i]
+            # Caches older than the detection file are stale and rebuilt
+            if os.path.exists(cache_path) and \
+                    os.path.getmtime(cache_path) >= os.path.getmtime(detection_path):
+                return torch.load(cache_path, map_location='cpu')
 
-        return dict(boxes=boxes, labels=labels, scores=scores)
+        with open(detection_path, 'r') as f:
+            detection = pocket.ops.to_tensor(json.load(f),
+                input_format='dict')
+        if self._det_cache_paths is None:
+            return detection
+        # Write to a temporary file first, so that other workers never
+        # read a partially written cache
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # Open the file here, so that failures to create it are raised as
+            # OSError. Write failures may still surface from the zip file writer
+            with open(tmp_path, 'wb') as f:
+                torch.save(detection, f)
+            os.replace(tmp_path, cache_path)
+        except (OSError, RuntimeError):
+            # Proceed without caching, e.g., in a read-only directory
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return detection
 
     def flip_boxes(self, detection, target, w):
         detection['boxes'] = pocket.ops.horizontal_flip_boxes(w, detection['boxes'])
@@ -124,34 +229,27 @@ class DataFactory(Dataset):
             target['labels'] = target['actions']
             target['object'] = target.pop('objects')
 
-        detection_path = os.path.join(
-            self.detection_root,
-            self.dataset.filename(i).replace('jpg', 'json')
-        )
-        with open(detection_path, 'r') as f:
-            detection = pocket.ops.to_tensor(json.load(f),
-                input_format='dict')
+        detection = self.load_detection(i)
 
-        if self._flip[i]:
-            image = hflip(image)
-            w, _ = image.size
-            self.flip_boxes(detection, target, w)
         image = pocket.ops.to_tensor(image, 'pil')
+        if self._flip[i]:
+            image = image.flip(-1)
+            self.flip_boxes(detection, target, image.shape[-1])
 
         return image, detection, target
 
 def test(net, test_loader):
     testset = test_loader.dataset.dataset
-    associate = BoxPairAssociation(min_iou=0.5)
 
     meter = DetectionAPMeter(
         600, nproc=1,
         num_gt=testset.anno_interaction,
         algorithm='11P'
     )
+    o2v = test_loader.dataset.interaction_lut
     net.eval()
     for batch in tqdm(test_loader):
-        inputs = pocket.ops.relocate_to_cuda(batch[:-1])
+        inputs = pocket.ops.relocate_to_cuda(batch[:-1], non_blocking=True)
         with torch.no_grad():
             output = net(*inputs)
         if output is None:
@@ -168,24 +266,27 @@ def test(net, test_loader):
         objects = output['object'][box_idx]
         scores = output['scores']
         verbs = output['prediction']
-        interactions = torch.tensor([
-            testset.object_n_verb_to_interaction[o][v]
-            for o, v in zip(objects, verbs)
-        ])
+        interactions = o2v[objects, verbs]
         # Associate detected pairs with ground truth pairs
         labels = torch.zeros_like(scores)
-        unique_hoi = interactions.unique()
-        for hoi_idx in unique_hoi:
-            gt_idx = torch.nonzero(target['hoi'] == hoi_idx).squeeze(1)
-            det_idx = torch.nonzero(interactions == hoi_idx).squeeze(1)
-            if len(gt_idx):
-                labels[det_idx] = associate(
-                    (target['boxes_h'][gt_idx].view(-1, 4),
-                    target['boxes_o'][gt_idx].view(-1, 4)),
-                    (boxes_h[det_idx].view(-1, 4),
-                    boxes_o[det_idx].view(-1, 4)),
-                    scores[det_idx].view(-1)
-                )
+        if len(target['hoi']) and len(interactions):
+            iou = box_pair_iou(
+                target['boxes_h'], target['boxes_o'],
+                boxes_h, boxes_o
+            )
+            # Pairs are only matched with ground truth of the same interaction
+            iou[target['hoi'][:, None] != interactions[None, :]] = -1
+            # Assign each detection to the ground truth with highest IoU
+            max_iou, max_idx = iou.max(0)
+            match = (max_idx[None, :] == torch.arange(len(iou))[:, None]) \
+                & (max_iou >= 0.5)[None, :]
+            # The highest scoring detection matched with each ground truth
+            # pair is a true positive
+            best = torch.where(
+                match, scores[None, :],
+                torch.full_like(iou, -float('inf'))
+            ).argmax(1)
+            labels[best[match.any(1)]] = 1
 
         meter.append(scores, interactions, labels)
 
@@ -201,6 +302,8 @@ class CustomisedDLE(DistributedLearningEngine):
         self.meter = DetectionAPMeter(self.num_classes, algorithm='11P')
         self.hoi_loss = pocket.utils.SyncedNumericalMeter(maxlen=self._print_interval)
         self.intr_loss = pocket.utils.SyncedNumericalMeter(maxlen=self._print_interval)
+        # Training results are copied to host and logged at the end of epoch
+        self._pending = []
 
     def _on_each_iteration(self):
         self._state.optimizer.zero_grad()
@@ -217,10 +320,19 @@ class CustomisedDLE(DistributedLearningEngine):
         self.hoi_loss.append(loss_dict['hoi_loss'])
         self.intr_loss.append(loss_dict['interactiveness_loss'])
 
-        self._synchronise_and_log_results(output, self.meter)
+        self._pending.append(
+            self._collate_results(output).to('cpu', non_blocking=True)
+        )
 
     def _on_end_epoch(self):
         timer = HandyTimer(maxlen=2)
+        # Log training results of the epoch all at once. Copies to host are
+        # asynchronous, and have to be completed before the results are read
+        torch.cuda.current_stream().synchronize()
+        results = torch.cat(self._pending, 1) if len(self._pending) \
+            else torch.zeros(2, 0)
+        self._pending = []
+        self._synchronise_and_log_results(results, self.meter)
         # Compute training mAP
         if self._rank == 0:
             with timer:
@@ -248,37 +360,60 @@ class CustomisedDLE(DistributedLearningEngine):
         self.hoi_loss.reset()
         self.intr_loss.reset()
 
-    def _synchronise_and_log_results(self, output, meter):
-        scores = []; pred = []; labels = []
-        # Collate results within the batch
-        for result in output:
-            scores.append(result['scores'].detach().cpu().numpy())
-            pred.append(result['prediction'].cpu().float().numpy())
-            labels.append(result["labels"].cpu().numpy())
-        # Sync across subprocesses
-        all_results = np.stack([
-            np.concatenate(scores),
-            np.concatenate(pred),
-            np.concatenate(labels)
+    def _collate_results(self, output):
+        """Collate results within the batch, without leaving the device"""
+        # Predicted classes and binary labels are small integers, and are
+        # packed into a single row, which is exact in single precision
+        return torch.stack([
+            torch.cat([result['scores'].detach() for result in output]),
+            torch.cat([
+                result['prediction'] * 2 + result['labels']
+                for result in output
+            ]).float()
         ])
-        all_results_sync = all_gather(all_results)
-        # Collate and log results in master process
-        if self._rank == 0:
-            scores, pred, labels = torch.from_numpy(
-                np.concatenate(all_results_sync, axis=1)
-            ).unbind(0)
-            meter.append(scores, pred, labels)
+
+    def _synchronise_and_log_results(self, results, meter, chunk_size=1 << 20):
+        # Sync across subprocesses. The number of results in each subprocess
+        # is gathered first, to determine the size of the buffers
+        device = torch.device('cuda', torch.cuda.current_device())
+        world_size = dist.get_world_size()
+        num = torch.as_tensor([results.shape[1]], device=device)
+        all_num = num.new_empty(world_size)
+        dist.all_gather_into_tensor(all_num, num)
+        all_num = all_num.tolist()
+        max_num = max(all_num)
+        # Results are padded to the same size and gathered to the master process
+        # only, in chunks of a capped size to bound the memory of the buffers
+        for start in range(0, max_num, chunk_size):
+            width = min(chunk_size, max_num - start)
+            buffer = torch.zeros(2, width, device=device)
+            chunk = results[:, start: start + width]
+            buffer[:, :chunk.shape[1]] = chunk.to(device, non_blocking=True)
+            gathered = [
+                torch.empty_like(buffer) for _ in range(world_size)
+            ] if self._rank == 0 else None
+            dist.gather(buffer, gathered, dst=0)
+            # Collate and log results in master process
+            if self._rank == 0:
+                scores, packed = torch.cat([
+                    r[:, :min(max(n - start, 0), width)]
+                    for r, n in zip(gathered, all_num)
+                ], 1).cpu().unbind(0)
+                packed = packed.long()
+                meter.append(scores, packed // 2, (packed % 2).float())
 
     @torch.no_grad()
     def validate(self):
         meter = DetectionAPMeter(self.num_classes, algorithm='11P')
         
         self._state.net.eval()
-        for batch in self.val_loader:
-            inputs = pocket.ops.relocate_to_cuda(batch)
+        # Copy of the next batch overlaps with the forward pass of the current
+        for inputs in CUDAPrefetcher(self.val_loader):
             results = self._state.net(*inputs)
 
-            self._synchronise_and_log_results(results, meter)
+            self._synchronise_and_log_results(
+                self._collate_results(results), meter
+            )
 
         # Evaluate mAP in master process
         if self._rank == 0: